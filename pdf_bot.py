@@ -1,20 +1,31 @@
+import io
 import os
 import sys
-import time
 import logging
+import math
+import re
 import asyncio
+import hashlib
+import shutil
 import threading
+import multiprocessing
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from telegram.error import TimedOut, NetworkError
 from PIL import Image
-from pdf2image import convert_from_path
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+from pypdf import PdfReader, PdfWriter, Transformation
+from pypdf.generic import ContentStream, DictionaryObject, FloatObject, NameObject, RectangleObject, StreamObject
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
-from flask import Flask
+from reportlab.lib.utils import ImageReader
+from aiohttp import web
 
 # Load environment variables
 try:
@@ -23,6 +34,25 @@ try:
 except ImportError:
     pass
 
+# Use uvloop for the bot's event loop where it is available
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Merge pages with qpdf where it is available; pypdf is the fallback
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# Render PDFs in-process with pdfium; poppler's pdftoppm is the fallback
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
@@ -37,29 +67,92 @@ if not TOKEN:
 
 PORT = int(os.getenv('PORT', 8080))
 
-# Temporary directory for processing
-TEMP_DIR = '/tmp/pdf_bot'
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Rasterization settings
+RENDER_DPI = 100
+MIN_RENDER_DPI, MAX_RENDER_DPI = 72, 150
+JPEG_QUALITY = 80
+POPPLER_PATHS = (None, '/opt/homebrew/bin', '/usr/bin')
+RENDER_WORKERS = os.cpu_count() or 2
+
+# pdfium calls are serialized across concurrent PDF jobs
+pdfium_lock = threading.Lock()
+
+# Worker processes that render scans in parallel, started in main(). Every worker imports
+# the whole bot (~70MB), so the pool is opt-in via RENDER_PROCESSES and capped by CPU count
+RENDER_PROCESSES = min(int(os.getenv('RENDER_PROCESSES', 0)), RENDER_WORKERS)
+render_pool = None
+render_pool_lock = threading.Lock()
+
+# Number of updates handled at the same time, and of PDFs downloaded and processed among them
+CONCURRENT_UPDATES = 16
+PDF_JOB_LIMIT = 2
+pdf_job_semaphore = asyncio.Semaphore(PDF_JOB_LIMIT)
+
+# Output page size in points
+PAGE_WIDTH, PAGE_HEIGHT = A4
 
-# Global storage for all processed pages
-all_processed_pages = []
+# Embed JPEG quadrants as raw DCT streams instead of ASCII85-encoding them
+rl_config.useA85 = 0
+
+# Processed pages per chat keyed by quadrant hash, least recently used chat first
+MAX_STORED_PAGES = 500
+MAX_STORED_BYTES = 200 * 1024 * 1024
+user_pages = OrderedDict()
+
+# Extracted pages of recently processed files keyed by Telegram's file_unique_id
+MAX_CACHED_FILES = 20
+MAX_CACHED_BYTES = 50 * 1024 * 1024
+processed_files = OrderedDict()
 start_time = datetime.now()
 
-# Simple Flask app for monitoring
-app = Flask(__name__)
+# Simple web app for monitoring, served on the bot's event loop
+routes = web.RouteTableDef()
 
-@app.route('/health')
-def health():
-    return {'status': 'healthy', 'pages': len(all_processed_pages)}
+@routes.get('/health')
+async def health(request):
+    return web.json_response({'status': 'healthy', 'pages': total_stored_pages()})
 
-@app.route('/ping')
-def ping():
-    return 'PONG'
+@routes.get('/ping')
+async def ping(request):
+    return web.Response(text='PONG')
 
-@app.route('/')
-def home():
+@routes.get('/')
+async def home(request):
     uptime = datetime.now() - start_time
-    return f"PDF Bot Running! Uptime: {str(uptime).split('.')[0]}, Pages: {len(all_processed_pages)}"
+    return web.Response(text=f"PDF Bot Running! Uptime: {str(uptime).split('.')[0]}, Pages: {total_stored_pages()}")
+
+def total_stored_pages():
+    """Count pages stored across all chats."""
+    return sum(len(pages) for pages in user_pages.values())
+
+def total_stored_bytes():
+    """Count bytes of page data stored across all chats."""
+    return sum(len(page) for pages in user_pages.values() for page in pages.values())
+
+def get_chat_pages(chat_id):
+    """Return the pages of a chat, keyed by content hash, and mark the chat as recently used."""
+    pages = user_pages.setdefault(chat_id, {})
+    user_pages.move_to_end(chat_id)
+    return pages
+
+def evict_old_chats():
+    """Drop least recently used chats while stored pages exceed MAX_STORED_PAGES or MAX_STORED_BYTES."""
+    total_pages = total_stored_pages()
+    total_bytes = total_stored_bytes()
+    # The current chat is never dropped; handle_pdf keeps it within both limits on its own
+    while (total_pages > MAX_STORED_PAGES or total_bytes > MAX_STORED_BYTES) and len(user_pages) > 1:
+        chat_id, pages = user_pages.popitem(last=False)
+        total_pages -= len(pages)
+        total_bytes -= sum(len(page) for page in pages.values())
+        logger.info(f"Evicted {len(pages)} pages of chat {chat_id}")
+
+def cache_processed_file(file_id, pages):
+    """Remember the extracted pages of a file, dropping the least recently used files over the caps."""
+    processed_files[file_id] = pages
+    total_bytes = sum(len(page) for pages in processed_files.values() for _, page in pages)
+    while (len(processed_files) > MAX_CACHED_FILES or total_bytes > MAX_CACHED_BYTES) and len(processed_files) > 1:
+        _, pages = processed_files.popitem(last=False)
+        total_bytes -= sum(len(page) for _, page in pages)
 
 async def start(update: Update, context):
     """Send a message when the command /start is issued."""
@@ -72,81 +165,477 @@ async def start(update: Update, context):
         'Отправляйте файлы по одному для лучшей стабильности!'
     )
 
-def extract_top_left_quadrant(pdf_path):
-    """Extract top-left quadrant from each page of a PDF."""
+def find_poppler_tool(name):
+    """Return the first poppler tool with this name found on PATH or in the usual poppler locations."""
+    for poppler_path in POPPLER_PATHS:
+        executable = shutil.which(name, path=poppler_path)
+        if executable:
+            return executable
+    return name
+
+# Looked up once so a missing binary doesn't cost failed spawns on every page
+PDFTOPPM = find_poppler_tool('pdftoppm')
+PDFINFO = find_poppler_tool('pdfinfo')
+
+def run_pdftoppm(args, pdf_data):
+    """Run pdftoppm on PDF bytes and return its stdout."""
+    return subprocess.run([PDFTOPPM, *args], input=pdf_data, capture_output=True, check=True).stdout
+
+def poppler_page_sizes(pdf_data):
+    """Read the displayed media box size of every page with pdfinfo, for PDFs pypdf can't parse."""
+    # pdfinfo clamps the last page to the document's page count
+    output = subprocess.run(
+        [PDFINFO, '-box', '-f', '1', '-l', str(2**31 - 1), '-'],
+        input=pdf_data, capture_output=True, check=True,
+    ).stdout.decode('latin-1')
+    boxes = re.findall(r'^Page\s+(\d+)\s+MediaBox:\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)', output, re.MULTILINE)
+    rotations = dict(re.findall(r'^Page\s+(\d+)\s+rot:\s+(-?\d+)', output, re.MULTILINE))
+    
+    sizes = []
+    for number, left, bottom, right, top in boxes:
+        width, height = abs(float(right) - float(left)), abs(float(top) - float(bottom))
+        if int(rotations.get(number, 0)) % 180:
+            width, height = height, width
+        sizes.append((width, height))
+    return sizes
+
+def render_dpi(page_width, page_height):
+    """Pick a DPI that gives any page about as many pixels as an A4 page at RENDER_DPI."""
+    dpi = RENDER_DPI * math.sqrt(PAGE_WIDTH * PAGE_HEIGHT / (page_width * page_height))
+    return min(MAX_RENDER_DPI, max(MIN_RENDER_DPI, dpi))
+
+def render_top_left_quadrant(pdf_data, page_number, page_width, page_height):
+    """Rasterize only the top-left quadrant of one page as JPEG bytes."""
+    dpi = render_dpi(page_width, page_height)
+    crop_width = int(page_width * dpi / 72) // 2
+    crop_height = int(page_height * dpi / 72) // 2
+    
+    return run_pdftoppm([
+        '-r', f'{dpi:.2f}',
+        '-f', str(page_number), '-l', str(page_number),
+        '-x', '0', '-y', '0', '-W', str(crop_width), '-H', str(crop_height),
+        '-jpeg', '-jpegopt', f'quality={JPEG_QUALITY}',
+        '-singlefile', '-',
+    ], pdf_data)
+
+class DraftImageReader(ImageReader):
+    """ImageReader that decodes JPEGs at 1/8 scale via PIL's draft mode.
+    
+    reportlab decodes an ImageReader only to fingerprint it and embeds the
+    original DCT stream, so reduced-size pixels are enough.
+    """
+    
+    def _read_image(self, fp):
+        image = Image.open(fp)
+        image.draft('RGB', (image.width // 8, image.height // 8))
+        return image
+
+def create_quadrant_page(jpeg_data):
+    """Wrap a JPEG quadrant into a single-page PDF filling a full A4 page."""
+    page_buffer = io.BytesIO()
+    
+    c = canvas.Canvas(page_buffer, pagesize=A4)
+    c.drawImage(
+        DraftImageReader(io.BytesIO(jpeg_data)), 0, 0,
+        width=PAGE_WIDTH, height=PAGE_HEIGHT, preserveAspectRatio=False
+    )
+    c.showPage()
+    c.save()
+    return page_buffer.getvalue()
+
+def hash_and_wrap_quadrant(jpeg_data):
+    """Return the content hash of a JPEG quadrant along with its single-page PDF."""
+    return hashlib.blake2b(jpeg_data, digest_size=16).digest(), create_quadrant_page(jpeg_data)
+
+def render_quadrant_page(pdf_data, page_number, page_width, page_height):
+    """Render the top-left quadrant of one page straight into a single-page PDF."""
+    return hash_and_wrap_quadrant(render_top_left_quadrant(pdf_data, page_number, page_width, page_height))
+
+def encode_quadrant_page(image):
+    """Encode a rendered quadrant as JPEG and wrap it into a single-page PDF."""
+    jpeg_buffer = io.BytesIO()
+    image.save(jpeg_buffer, 'JPEG', quality=JPEG_QUALITY)
+    image.close()
+    return hash_and_wrap_quadrant(jpeg_buffer.getvalue())
+
+def render_quadrant_image(pdf, page_index):
+    """Render the top-left quadrant of one pdfium page as a PIL image."""
+    with pdfium_lock:
+        page = pdf[page_index]
+        width, height = page.get_size()
+        scale = render_dpi(width, height) / 72
+        bitmap = page.render(scale=scale, crop=(0, height / 2, width / 2, 0))
+        image = bitmap.to_pil()
+        bitmap.close()
+        page.close()
+    return image
+
+def render_quadrant_page_range(pdf_data, start, stop):
+    """Render and wrap the quadrants of pages start..stop-1 inside a render worker process."""
+    pdf = pdfium.PdfDocument(pdf_data)
+    try:
+        return [encode_quadrant_page(render_quadrant_image(pdf, i)) for i in range(start, stop)]
+    finally:
+        pdf.close()
+
+def create_render_pool():
+    """Start RENDER_PROCESSES fresh worker processes for rendering scans."""
+    return ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+
+def restart_render_pool(broken_pool):
+    """Replace a pool whose worker died, unless a concurrent job already has."""
+    global render_pool
+    with render_pool_lock:
+        if render_pool is broken_pool:
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            render_pool = create_render_pool()
+
+def render_quadrant_pages_pool(pool, pdf_data, page_count):
+    """Render page ranges in the worker processes, each of which has its own pdfium."""
+    chunk_size = -(-page_count // RENDER_PROCESSES)
+    futures = [
+        pool.submit(render_quadrant_page_range, pdf_data, start, min(start + chunk_size, page_count))
+        for start in range(0, page_count, chunk_size)
+    ]
+    return [page for future in futures for page in future.result()]
+
+def render_quadrant_pages_pdfium(pdf_data):
+    """Render the top-left quadrant of every page with pdfium."""
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_data)
+        page_count = len(pdf)
+    
     try:
-        images = convert_from_path(pdf_path)
-    except Exception:
-        try:
-            images = convert_from_path(pdf_path, poppler_path='/opt/homebrew/bin')
-        except Exception:
-            images = convert_from_path(pdf_path, poppler_path='/usr/bin')
+        pool = render_pool
+        if pool and page_count > 1:
+            try:
+                return render_quadrant_pages_pool(pool, pdf_data, page_count)
+            except BrokenProcessPool:
+                # A worker crashed or was OOM-killed; later jobs get a fresh pool, this one renders here
+                logger.warning("Render worker died, restarting the pool and rendering in-process")
+                restart_render_pool(pool)
+        
+        max_pending = 2 * RENDER_WORKERS
+        
+        # pdfium is not thread-safe: render under the lock, encode and wrap pages in the pool
+        with ThreadPoolExecutor(max_workers=RENDER_WORKERS) as executor:
+            futures = []
+            for i in range(page_count):
+                image = render_quadrant_image(pdf, i)
+                futures.append(executor.submit(encode_quadrant_page, image))
+                
+                # Don't let rendered pages pile up faster than they are encoded
+                if len(futures) > max_pending:
+                    futures[-max_pending - 1].result()
+            
+            return [future.result() for future in futures]
+    finally:
+        with pdfium_lock:
+            pdf.close()
+
+# Annotation flags that keep an annotation off the page: Hidden and NoView
+HIDDEN_ANNOTATION_FLAGS = 2 | 32
+
+def resolve(obj):
+    """Follow an indirect pypdf reference, passing None through."""
+    return obj.get_object() if obj is not None else None
+
+def flatten_annotations(page, writer):
+    """Draw the appearance of every visible annotation into the page content and drop the annotations."""
+    annotations = resolve(page.get('/Annots'))
+    if annotations is None:
+        return
     
-    quadrant_images = []
-    timestamp = int(time.time() * 1000)
+    resources = resolve(page.get('/Resources'))
+    if resources is None:
+        resources = page[NameObject('/Resources')] = DictionaryObject()
+    xobjects = resolve(resources.get('/XObject'))
+    if xobjects is None:
+        xobjects = resources[NameObject('/XObject')] = DictionaryObject()
     
-    for i, img in enumerate(images):
-        width, height = img.size
-        quadrant_width = width // 2
-        quadrant_height = height // 2
-        quadrant = img.crop((0, 0, quadrant_width, quadrant_height))
+    operations = []
+    for i, annotation in enumerate(map(resolve, annotations)):
+        # Null or dangling entries resolve to NullObject
+        if not isinstance(annotation, DictionaryObject):
+            continue
+        if int(resolve(annotation.get('/F')) or 0) & HIDDEN_ANNOTATION_FLAGS:
+            continue
+        appearances = resolve(annotation.get('/AP'))
+        if not isinstance(appearances, DictionaryObject):
+            continue
+        appearance = resolve(appearances.get('/N'))
+        if isinstance(appearance, DictionaryObject) and not isinstance(appearance, StreamObject):
+            # Widgets such as checkboxes keep one appearance per state
+            appearance = resolve(appearance.get(resolve(annotation.get('/AS'))))
+        if not isinstance(appearance, StreamObject) or '/BBox' not in appearance or '/Rect' not in annotation:
+            continue
         
-        quadrant_path = os.path.join(TEMP_DIR, f'quadrant_{timestamp}_{i}.png')
-        quadrant.save(quadrant_path, optimize=True)
-        quadrant_images.append(quadrant_path)
+        # Map the appearance's transformed BBox onto the annotation's Rect (PDF 32000-1, 12.5.5)
+        a, b, c, d, e, f = (float(x) for x in appearance.get('/Matrix', (1, 0, 0, 1, 0, 0)))
+        x0, y0, x1, y1 = (float(x) for x in appearance['/BBox'])
+        corners = [(a * x + c * y + e, b * x + d * y + f) for x in (x0, x1) for y in (y0, y1)]
+        box_left, box_right = min(x for x, _ in corners), max(x for x, _ in corners)
+        box_bottom, box_top = min(y for _, y in corners), max(y for _, y in corners)
+        rect = RectangleObject(annotation['/Rect'])
+        if box_right == box_left or box_top == box_bottom:
+            continue
+        scale_x = float(rect.width) / (box_right - box_left)
+        scale_y = float(rect.height) / (box_top - box_bottom)
+        
+        name = NameObject(f'/FlatAnnot{i}')
+        xobjects[name] = appearance.indirect_reference or writer._add_object(appearance)
+        operations += [
+            ([], b'q'),
+            ([FloatObject(v) for v in (
+                scale_x, 0, 0, scale_y,
+                float(rect.left) - box_left * scale_x, float(rect.bottom) - box_bottom * scale_y,
+            )], b'cm'),
+            ([name], b'Do'),
+            ([], b'Q'),
+        ]
     
-    return quadrant_images
+    if operations:
+        content = page.get_contents()
+        if content is None:
+            content = ContentStream(None, writer)
+        content.operations = [([], b'q'), *content.operations, ([], b'Q'), *operations]
+        page.replace_contents(content)
+    del page['/Annots']
 
-def create_pdf_from_images(image_paths):
-    """Convert images to PDFs with each image on a full A4 page."""
-    output_path = os.path.join(TEMP_DIR, 'combined_quadrants.pdf')
+def has_page_sized_image(resources, page_width, page_height, seen=None):
+    """Tell whether resources hold an image with at least one pixel per point of the page, like a scan."""
+    xobjects = resolve(resources.get('/XObject')) if isinstance(resources, DictionaryObject) else None
+    if not isinstance(xobjects, DictionaryObject):
+        return False
     
-    c = canvas.Canvas(output_path, pagesize=A4)
-    page_width, page_height = A4
+    seen = set() if seen is None else seen
+    page_sides = sorted((page_width, page_height))
+    for xobject in map(resolve, xobjects.values()):
+        # Dangling references resolve to None or NullObject
+        if not isinstance(xobject, DictionaryObject) or id(xobject) in seen:
+            continue
+        seen.add(id(xobject))
+        
+        subtype = xobject.get('/Subtype')
+        if subtype == '/Image':
+            image_sides = sorted((float(xobject.get('/Width', 0)), float(xobject.get('/Height', 0))))
+            if image_sides[0] >= page_sides[0] and image_sides[1] >= page_sides[1]:
+                return True
+        elif subtype == '/Form':
+            # reportlab and many scanners wrap the page image into a form
+            if has_page_sized_image(resolve(xobject.get('/Resources')), page_width, page_height, seen):
+                return True
+    return False
+
+def crop_quadrant_pages(pdf_data):
+    """Scale the top-left quadrant of every page up to A4 without rasterizing it, or return None for scans."""
+    reader = PdfReader(io.BytesIO(pdf_data))
+    pages = []
     
-    for img_path in image_paths:
-        img = Image.open(img_path)
-        img_resized = img.resize((int(page_width), int(page_height)), Image.LANCZOS)
+    for source_page in reader.pages:
+        # A cropped scan would still carry its whole page image, so scans are rasterized instead
+        box = source_page.cropbox
+        if has_page_sized_image(resolve(source_page.get('/Resources')), float(box.width), float(box.height)):
+            return None
+        
+        writer = PdfWriter()
+        page = writer.add_page(source_page)
+        
+        # Annotations don't follow content transformations, so they become part of the content
+        flatten_annotations(page, writer)
+        
+        # Crop in visual orientation, the way the page is displayed
+        if page.rotation % 360:
+            page.transfer_rotation_to_content()
+        
+        box = page.cropbox
+        left, bottom = float(box.left), float(box.bottom)
+        width, height = float(box.width), float(box.height)
         
-        resized_path = img_path.replace('.png', '_full.png')
-        img_resized.save(resized_path)
+        # Stretch the quadrant over the whole A4 page, like the raster path does
+        page.add_transformation(
+            Transformation()
+            .translate(-left, -(bottom + height / 2))
+            .scale(PAGE_WIDTH / (width / 2), PAGE_HEIGHT / (height / 2))
+        )
+        page.mediabox = RectangleObject((0, 0, PAGE_WIDTH, PAGE_HEIGHT))
+        page.cropbox = page.mediabox
+        for name in ('/BleedBox', '/TrimBox', '/ArtBox'):
+            page.pop(NameObject(name), None)
         
-        c.drawImage(resized_path, 0, 0, width=page_width, height=page_height)
-        c.showPage()
+        page.compress_content_streams()
+        page_buffer = io.BytesIO()
+        writer.write(page_buffer)
+        writer.close()
+        page_data = page_buffer.getvalue()
+        pages.append((hashlib.blake2b(page_data, digest_size=16).digest(), page_data))
     
-    c.save()
-    return output_path
+    return pages
+
+def extract_top_left_quadrant(pdf_data):
+    """Extract the top-left quadrant of each page as (hash, single-page PDF) pairs."""
+    try:
+        pages = crop_quadrant_pages(pdf_data)
+        if pages is not None:
+            return pages
+    except Exception as e:
+        logger.warning(f"Cropping failed, rasterizing pages instead: {e}")
+    
+    if pdfium:
+        return render_quadrant_pages_pdfium(pdf_data)
+    
+    # Page sizes come from poppler too, since pypdf may be what just failed to read the file
+    page_sizes = poppler_page_sizes(pdf_data)
+    
+    # Each page is rendered by its own pdftoppm process, so threads are enough to use all cores
+    with ThreadPoolExecutor(max_workers=RENDER_WORKERS) as executor:
+        futures = [
+            executor.submit(render_quadrant_page, pdf_data, i + 1, width, height)
+            for i, (width, height) in enumerate(page_sizes)
+        ]
+        return [future.result() for future in futures]
+
+def hash_field(h, data):
+    """Feed length-prefixed bytes to a hash so adjacent fields can't run into each other."""
+    h.update(len(data).to_bytes(8, 'big'))
+    h.update(data)
+
+def pdf_object_digest(obj, digests):
+    """Hash a pikepdf object together with everything it references, memoized by object id."""
+    if not isinstance(obj, pikepdf.Object):
+        # pikepdf hands numbers and booleans back as plain Python values
+        return hashlib.blake2b(f'{type(obj).__name__}:{obj!r}'.encode(), digest_size=16).digest()
+    if obj.is_indirect:
+        if obj.objgen in digests:
+            return digests[obj.objgen]
+        # Placeholder in case the object refers back to itself
+        digests[obj.objgen] = hashlib.blake2b(f'ref:{obj.objgen}'.encode(), digest_size=16).digest()
+    
+    # Child digests are all 16 bytes; everything of variable length is tagged or length-prefixed
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+        if isinstance(obj, pikepdf.Stream):
+            h.update(b'S')
+            hash_field(h, obj.read_raw_bytes())
+        else:
+            h.update(b'D')
+        for key in sorted(obj.keys()):
+            if key != '/Length':
+                hash_field(h, key.encode())
+                h.update(pdf_object_digest(obj[key], digests))
+    elif isinstance(obj, pikepdf.Array):
+        h.update(b'A')
+        for item in obj:
+            h.update(pdf_object_digest(item, digests))
+    else:
+        h.update(b'O')
+        hash_field(h, obj.unparse())
+    
+    digest = h.digest()
+    if obj.is_indirect:
+        digests[obj.objgen] = digest
+    return digest
+
+def share_identical_resources(pdf):
+    """Point identical fonts and images of different pages at a single copy."""
+    digests = {}
+    shared = {}
+    for page in pdf.pages:
+        resources = page.obj.get('/Resources')
+        if resources is None:
+            continue
+        for category in ('/Font', '/XObject'):
+            entries = resources.get(category)
+            if entries is None:
+                continue
+            for name in list(entries.keys()):
+                resource = entries[name]
+                if resource.is_indirect:
+                    first = shared.setdefault(pdf_object_digest(resource, digests), resource)
+                    if first.objgen != resource.objgen:
+                        entries[name] = first
+
+def create_pdf_from_images(pages):
+    """Merge single-page quadrant PDFs into one in-memory PDF."""
+    pdf_buffer = io.BytesIO()
+    
+    if pikepdf:
+        # Source documents must stay open until the merged one is saved
+        sources = []
+        with pikepdf.Pdf.new() as combined:
+            for page_data in pages:
+                sources.append(pikepdf.open(io.BytesIO(page_data)))
+                combined.pages.extend(sources[-1].pages)
+            # Every cropped page carries its own copy of the source's fonts; unreferenced copies aren't saved
+            share_identical_resources(combined)
+            # Packing the many small per-page objects into object streams shrinks vector output a lot
+            combined.save(pdf_buffer, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+        for source in sources:
+            source.close()
+    else:
+        writer = PdfWriter()
+        for page_data in pages:
+            writer.append(io.BytesIO(page_data))
+        writer.compress_identical_objects()
+        writer.write(pdf_buffer)
+        writer.close()
+    
+    pdf_buffer.seek(0)
+    return pdf_buffer
 
 async def handle_pdf(update: Update, context):
     """Handle incoming PDF files."""
-    global all_processed_pages
-    
-    pdf_path = None
     wait_message = None
     
     try:
         wait_message = await update.message.reply_text('Загрузка файла...')
         
-        pdf_file = await asyncio.wait_for(
-            update.message.document.get_file(), 
-            timeout=60.0
-        )
-        
-        pdf_path = os.path.join(TEMP_DIR, f"temp_{int(time.time())}_{update.message.document.file_name}")
-        
-        await asyncio.wait_for(
-            pdf_file.download_to_drive(pdf_path),
-            timeout=120.0
-        )
-        
-        await wait_message.edit_text('Обработка PDF...')
-        
-        quadrant_images = extract_top_left_quadrant(pdf_path)
-        all_processed_pages.extend(quadrant_images)
+        # Files that are resent or forwarded again are neither downloaded nor rendered twice
+        file_id = update.message.document.file_unique_id
+        quadrant_images = processed_files.get(file_id)
+        if quadrant_images is not None:
+            processed_files.move_to_end(file_id)
+        else:
+            # Downloads count as jobs too, so queued uploads don't all hold their bytes at once
+            async with pdf_job_semaphore:
+                pdf_file = await asyncio.wait_for(
+                    update.message.document.get_file(), 
+                    timeout=60.0
+                )
+                
+                pdf_data = bytes(await asyncio.wait_for(
+                    pdf_file.download_as_bytearray(),
+                    timeout=120.0
+                ))
+                
+                await wait_message.edit_text('Обработка PDF...')
+                
+                quadrant_images = await asyncio.to_thread(extract_top_left_quadrant, pdf_data)
+            cache_processed_file(file_id, quadrant_images)
+        chat_pages = get_chat_pages(update.effective_chat.id)
+        chat_bytes = sum(len(page) for page in chat_pages.values())
+        duplicates = rejected = 0
+        for page_hash, page in quadrant_images:
+            if page_hash in chat_pages:
+                duplicates += 1
+            elif len(chat_pages) >= MAX_STORED_PAGES or chat_bytes + len(page) > MAX_STORED_BYTES:
+                # Other chats can be evicted, but a single chat must stay within the limits itself
+                rejected += 1
+            else:
+                chat_pages[page_hash] = page
+                chat_bytes += len(page)
+        evict_old_chats()
         
-        total_pages = len(all_processed_pages)
+        total_pages = len(chat_pages)
+        duplicates_msg = f'Пропущено повторяющихся страниц: {duplicates}\n' if duplicates else ''
+        rejected_msg = (
+            f'Не добавлено страниц (достигнут лимит хранения): {rejected}\n'
+            f'Отправь накопленное через /send и очисти через /clear\n'
+        ) if rejected else ''
         await wait_message.edit_text(
             f'PDF обработан! Извлечено {len(quadrant_images)} страниц.\n'
+            f'{duplicates_msg}'
+            f'{rejected_msg}'
             f'Всего накоплено страниц: {total_pages}\n'
             f'Используй /send для получения объединенного PDF'
         )
@@ -158,45 +647,41 @@ async def handle_pdf(update: Update, context):
         else:
             await update.message.reply_text(error_msg)
         logger.error(f"Error processing PDF: {e}")
-    
-    finally:
-        if pdf_path and os.path.exists(pdf_path):
-            try:
-                os.remove(pdf_path)
-            except Exception as e:
-                logger.error(f"Error removing temp file: {e}")
 
 async def send_combined_pdf(update: Update, context):
     """Send combined PDF with all processed pages."""
-    global all_processed_pages
+    pages = user_pages.get(update.effective_chat.id)
     
-    if not all_processed_pages:
+    if not pages:
         await update.message.reply_text('Нет обработанных страниц!')
         return
     
-    result_pdf_path = None
     wait_message = None
     
     try:
         wait_message = await update.message.reply_text('Создание объединенного PDF...')
         
-        result_pdf_path = create_pdf_from_images(all_processed_pages)
+        # Snapshot the pages: uploads may add to this chat while the merge runs
+        snapshot = list(pages.values())
+        async with pdf_job_semaphore:
+            pdf_buffer = await asyncio.to_thread(create_pdf_from_images, snapshot)
         
-        file_size = os.path.getsize(result_pdf_path)
+        file_size = pdf_buffer.getbuffer().nbytes
         if file_size > 50 * 1024 * 1024:
             await wait_message.edit_text('PDF слишком большой (>50MB).')
             return
         
         await wait_message.edit_text('Отправка PDF...')
         
-        with open(result_pdf_path, 'rb') as pdf_file:
-            await asyncio.wait_for(
-                update.message.reply_document(
-                    pdf_file, 
-                    caption=f'Объединенный PDF готов! Всего страниц: {len(all_processed_pages)}'
-                ),
-                timeout=300.0
-            )
+        await asyncio.wait_for(
+            update.message.reply_document(
+                pdf_buffer,
+                filename='combined_quadrants.pdf',
+                caption=f'Объединенный PDF готов! Всего страниц: {len(snapshot)}',
+                write_timeout=300.0
+            ),
+            timeout=300.0
+        )
         
         await wait_message.edit_text('PDF успешно отправлен!')
             
@@ -207,37 +692,15 @@ async def send_combined_pdf(update: Update, context):
         else:
             await update.message.reply_text(error_msg)
         logger.error(f"Error creating combined PDF: {e}")
-    
-    finally:
-        if result_pdf_path and os.path.exists(result_pdf_path):
-            try:
-                os.remove(result_pdf_path)
-            except Exception as e:
-                logger.error(f"Error removing result file: {e}")
 
 async def clear_pages(update: Update, context):
     """Clear all accumulated pages."""
-    global all_processed_pages
-    
-    page_count = len(all_processed_pages)
-    all_processed_pages.clear()
-    
-    try:
-        for file in os.listdir(TEMP_DIR):
-            if file.startswith('quadrant_') and file.endswith('.png'):
-                file_path = os.path.join(TEMP_DIR, file)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-    except Exception as e:
-        logger.error(f"Error cleaning up temp files: {e}")
-    
+    page_count = len(user_pages.pop(update.effective_chat.id, {}))
     await update.message.reply_text(f'Очищено {page_count} страниц!')
 
 async def status(update: Update, context):
     """Show current status."""
-    global all_processed_pages
-    
-    page_count = len(all_processed_pages)
+    page_count = len(user_pages.get(update.effective_chat.id, {}))
     uptime = datetime.now() - start_time
     
     if page_count == 0:
@@ -248,21 +711,41 @@ async def status(update: Update, context):
         status_msg += f'Используйте /send для получения PDF'
         await update.message.reply_text(status_msg)
 
-def run_flask():
-    """Run Flask server in background."""
-    app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
+async def start_web_server(application):
+    """Start the monitoring web server once the bot is initialized."""
+    web_app = web.Application()
+    web_app.add_routes(routes)
+    
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    application.bot_data['web_runner'] = runner
+    logger.info(f"Web server started on port {PORT}")
+
+async def stop_web_server(application):
+    """Stop the monitoring web server on shutdown."""
+    runner = application.bot_data.pop('web_runner', None)
+    if runner:
+        await runner.cleanup()
 
 def main():
     """Start the bot."""
+    global render_pool
     logger.info("Starting PDF bot...")
     
-    # Start Flask server in background
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"Flask server started on port {PORT}")
+    if pdfium and RENDER_PROCESSES > 1:
+        render_pool = create_render_pool()
     
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(start_web_server)
+        .post_shutdown(stop_web_server)
+        .build()
+    )
     
+    # Add handlers
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("send", send_combined_pdf))
@@ -272,7 +755,11 @@ def main():
     
     # Start polling
     logger.info("Starting bot polling...")
-    application.run_polling(drop_pending_updates=True)
+    try:
+        application.run_polling(drop_pending_updates=True)
+    finally:
+        if render_pool:
+            render_pool.shutdown(cancel_futures=True)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file